@@ -1,10 +1,15 @@
 import io
 import logging
 import asyncio
+import time
+import hashlib
+import itertools
 import traceback
 import html
 import json
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import OrderedDict
+from functools import wraps
 import openai
 
 import telegram
@@ -30,7 +35,6 @@ from telegram.constants import ParseMode
 import config
 import openai_utils
 
-import base64
 
 # Инициализация базы данных и логгера
 def init_database():
@@ -41,10 +45,275 @@ def init_database():
 
 logger = logging.getLogger(__name__)  # Создание логгера для текущего модуля
 
+# Предзагруженная временная зона: datetime.now(tz) с готовым tz-объектом не ходит
+# в системную базу временных зон на каждый вызов
+_UTC = timezone.utc
+
+# Сериализация JSON: используем orjson (C-расширение, в разы быстрее stdlib), если он установлен
+try:
+    import orjson
+
+    def _json_dumps(obj, indent: bool = False) -> str:
+        # OPT_NON_STR_KEYS - чтобы не падать на словарях с нестроковыми ключами (как stdlib json)
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode("utf-8")
+except ImportError:
+    def _json_dumps(obj, indent: bool = False) -> str:
+        return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
+
 # Словари для хранения семафоров и задач пользователей
-user_semaphores = {}
+user_semaphores: "OrderedDict[int, asyncio.Semaphore]" = OrderedDict()
 user_tasks = {}
 
+# Ограничение на количество семафоров в памяти (LRU-вытеснение самых старых)
+MAX_USER_SEMAPHORES = 10_000
+
+# Сильные ссылки на фоновые задачи: asyncio хранит только слабые ссылки на Task,
+# и без этого множества задача может быть собрана GC посреди выполнения.
+_background_tasks: set = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """
+    Создает фоновую задачу и удерживает на нее сильную ссылку до завершения.
+
+    Аргументы:
+    coro -- корутина, которую нужно запустить.
+
+    Описание:
+    - Задача регистрируется в _background_tasks и удаляется оттуда по завершении,
+      чтобы сборщик мусора не отменил ее молча посреди выполнения.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _build_user_filter():
+    """
+    Собирает фильтр доступа к боту из config.allowed_telegram_usernames.
+
+    Описание:
+    - Список из конфигурации разбирается один раз при загрузке модуля;
+      frozenset дает O(1) проверку принадлежности на каждый апдейт
+      вместо линейного поиска по списку.
+    """
+    if not config.allowed_telegram_usernames:
+        return filters.ALL
+
+    usernames = frozenset(x for x in config.allowed_telegram_usernames if isinstance(x, str))
+    any_ids = [x for x in config.allowed_telegram_usernames if isinstance(x, int)]
+    user_ids = frozenset(x for x in any_ids if x > 0)
+    group_ids = frozenset(x for x in any_ids if x < 0)
+    return filters.User(username=usernames) | filters.User(user_id=user_ids) | filters.Chat(chat_id=group_ids)
+
+
+# Фильтр доступа (разрешенные пользователи/группы), общий для всех обработчиков
+USER_FILTER = _build_user_filter()
+
+
+# Кэш результатов генерации изображений: sha256(prompt|size|n) -> (срок годности, список URL).
+# Повторный запрос с тем же текстом не тратит деньги на вызов DALL-E.
+_image_cache: dict = {}
+
+# Ограничение размера кеша изображений
+_IMAGE_CACHE_MAX_SIZE = 1_000
+
+
+# Буфер отложенной записи last_interaction: user_id -> unix-время.
+# Обработчики пишут сюда синхронно, фоновая задача сбрасывает буфер в Mongo
+# одним bulk_write раз в несколько секунд.
+_last_interaction_buf: dict = {}
+
+# Период сброса буфера last_interaction в Mongo, секунды
+LAST_INTERACTION_FLUSH_PERIOD = 5.0
+
+# Фоновая задача сброса буфера (создается в post_init)
+_last_interaction_flush_task = None
+
+
+async def _flush_last_interactions():
+    """
+    Сбрасывает накопленный буфер last_interaction в Mongo одним bulk_write.
+    """
+    if not _last_interaction_buf:
+        return
+
+    values = dict(_last_interaction_buf)
+    _last_interaction_buf.clear()
+    try:
+        await db.flush_last_interactions(values)
+    except Exception as e:
+        logger.error("Не удалось сбросить буфер last_interaction: %s", e)
+
+
+async def _last_interaction_flush_loop():
+    """
+    Фоновый цикл: раз в LAST_INTERACTION_FLUSH_PERIOD секунд сбрасывает буфер
+    last_interaction в базу. Коллапсирует O(апдейтов) записей в одну на интервал.
+    """
+    while True:
+        await asyncio.sleep(LAST_INTERACTION_FLUSH_PERIOD)
+        await _flush_last_interactions()
+
+
+# Период сброса очереди обновлений статистики токенов в Mongo, секунды
+TOKEN_FLUSH_PERIOD = 0.25
+
+# Фоновая задача сброса очереди токенов (создается в post_init)
+_token_flush_task = None
+
+
+async def _flush_token_updates():
+    """
+    Сбрасывает очередь отложенных обновлений статистики токенов в Mongo.
+    """
+    try:
+        await db.flush_token_updates()
+    except Exception as e:
+        logger.error("Не удалось сбросить очередь статистики токенов: %s", e)
+
+
+async def _token_flush_loop():
+    """
+    Фоновый цикл: раз в TOKEN_FLUSH_PERIOD секунд сбрасывает очередь отложенных
+    $inc по токенам одним bulk_write вместо отдельного update_one на каждый ответ.
+    """
+    while True:
+        await asyncio.sleep(TOKEN_FLUSH_PERIOD)
+        await _flush_token_updates()
+
+
+# Фоновая инициализация нового диалога: user_id -> Task.
+# Ответ пользователю уходит сразу, а обработчики сообщений дожидаются
+# завершения инициализации через _await_dialog_init.
+_pending_dialog_init: dict = {}
+
+
+def _spawn_dialog_init(user_id: int) -> asyncio.Task:
+    """
+    Запускает создание нового диалога в фоне, не задерживая ответ пользователю.
+
+    Аргументы:
+    user_id -- идентификатор пользователя
+    """
+    task = spawn(db.start_new_dialog(user_id))
+    _pending_dialog_init[user_id] = task
+
+    def _cleanup(t, uid=user_id):
+        if _pending_dialog_init.get(uid) is t:
+            del _pending_dialog_init[uid]
+
+    task.add_done_callback(_cleanup)
+    return task
+
+
+async def _await_dialog_init(user_id: int):
+    """
+    Дожидается фоновой инициализации диалога пользователя, если она еще идет.
+
+    Аргументы:
+    user_id -- идентификатор пользователя
+    """
+    task = _pending_dialog_init.get(user_id)
+    if task is not None:
+        await task
+
+
+def _get_semaphore(user_id: int) -> asyncio.Semaphore:
+    """
+    Возвращает семафор пользователя, создавая его при необходимости.
+
+    Аргументы:
+    user_id -- идентификатор пользователя
+
+    Описание:
+    - Словарь семафоров ограничен по размеру: при превышении MAX_USER_SEMAPHORES
+      вытесняется самый давно не использовавшийся, чтобы память не росла бесконечно.
+    - Захваченные семафоры не вытесняются: иначе владелец получил бы новый
+      свободный семафор и две генерации пошли бы для него параллельно.
+    """
+    semaphore = user_semaphores.get(user_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+        user_semaphores[user_id] = semaphore
+        if len(user_semaphores) > MAX_USER_SEMAPHORES:
+            # Удаляем самый старый незахваченный семафор
+            for old_user_id, old_semaphore in user_semaphores.items():
+                if not old_semaphore.locked():
+                    del user_semaphores[old_user_id]
+                    break
+    else:
+        user_semaphores.move_to_end(user_id)
+
+    return semaphore
+
+# Минимальный интервал (в секундах) между редактированиями сообщения при потоковой генерации
+EDIT_INTERVAL = 1.2
+
+# Отказ OpenAI по соображениям безопасности: стабильный код ошибки и префикс текста
+_SAFETY_REJECTION_CODE = "content_policy_violation"
+_SAFETY_REJECTION_PREFIX = "Your request was rejected as a result of our safety system"
+
+# Текст, отправляемый пользователю при таком отказе
+SAFETY_REJECTION_TEXT = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies.\nWhat did you write there, huh?"
+
+
+def _is_safety_rejection(e: openai.error.InvalidRequestError) -> bool:
+    """
+    Проверяет, что InvalidRequestError вызван системой безопасности OpenAI.
+
+    Описание:
+    - Сначала смотрит на стабильный код ошибки из ответа API и только потом
+      откатывается на сравнение текста по префиксу.
+    """
+    if getattr(e, "code", None) == _SAFETY_REJECTION_CODE:
+        return True
+
+    user_message = getattr(e, "user_message", None) or str(e)
+    return user_message.startswith(_SAFETY_REJECTION_PREFIX)
+
+
+# Префикс ошибки Telegram при попытке заменить сообщение тем же текстом
+_MSG_NOT_MODIFIED = "Message is not modified"
+
+
+def _is_not_modified(e: telegram.error.BadRequest) -> bool:
+    """
+    Проверяет, что BadRequest вызван редактированием сообщения тем же текстом.
+    """
+    return e.message.startswith(_MSG_NOT_MODIFIED)
+
+# Соответствие режима парсинга из конфигурации режимов чата значениям Telegram
+PARSE_MODE_MAP = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}
+
+# Приветственные сообщения режимов чата статичны - достаем их из конфигурации один раз
+_WELCOME = {chat_mode_key: v["welcome_message"] for chat_mode_key, v in config.chat_modes.items()}
+
+# Модели, умеющие обрабатывать изображения
+VISION_MODELS = frozenset(("gpt-4-vision-preview", "gpt-4o"))
+
+# Кэшированное упоминание бота ("@username"), заполняется в post_init
+BOT_USERNAME_AT = None
+
+# Кэш экземпляров ChatGPT по имени модели, чтобы не создавать объект на каждое сообщение
+_chatgpt_cache: dict = {}
+
+
+def get_chatgpt(model: str) -> "openai_utils.ChatGPT":
+    """
+    Возвращает закэшированный экземпляр ChatGPT для указанной модели.
+
+    Аргументы:
+    model -- имя модели OpenAI
+
+    Описание:
+    - Экземпляры не хранят состояния диалога, поэтому один объект на модель
+      можно безопасно переиспользовать между пользователями и сообщениями.
+    """
+    return _chatgpt_cache.setdefault(model, openai_utils.ChatGPT(model=model))
+
 # Сообщение с перечнем доступных команд для пользователя
 HELP_MESSAGE = """Commands:
 ⚪ /retry – Восстановить последний ответ бота
@@ -72,6 +341,128 @@ HELP_GROUP_CHAT_MESSAGE = """Вы можете добавить бота в лю
 """
 
 
+class TypingKeeper:
+    """
+    Асинхронный контекстный менеджер, поддерживающий индикатор "печатает" в чате.
+
+    Описание:
+    - Telegram показывает действие "typing" только ~5 секунд, поэтому при длинной генерации
+      индикатор пропадает. Внутри блока `async with` фоновая задача повторяет действие
+      каждые 4 секунды и отменяется при выходе из блока.
+    """
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.bot.send_chat_action(self.chat_id, action="typing")
+            except Exception as e:
+                # Индикатор - чистая косметика: при сбое (RetryAfter, сеть)
+                # логируем и пробуем снова на следующей итерации, иначе задача
+                # умерла бы с неизвлеченным исключением
+                logger.warning("Не удалось отправить индикатор 'печатает': %s", e)
+            await asyncio.sleep(4)
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._loop())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        return False
+
+
+async def _stream_answer_to_message(context: CallbackContext, placeholder_message, parse_mode, gen):
+    """
+    Читает ответ из потокового генератора и обновляет placeholder-сообщение.
+
+    Аргументы:
+    context -- контекст, передаваемый в колбэк функции
+    placeholder_message -- сообщение-заполнитель, которое редактируется по мере генерации
+    parse_mode -- режим парсинга для Telegram
+    gen -- асинхронный генератор, выдающий (status, answer, (n_input, n_output), n_removed)
+
+    Возвращает:
+    Кортеж (answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed).
+
+    Описание:
+    - Редактирование вынесено в отдельную задачу по принципу "последний выигрывает":
+      генератор лишь обновляет общий слот с самым свежим текстом, а задача-писатель
+      отправляет его не чаще, чем раз в EDIT_INTERVAL секунд. Устаревшие промежуточные
+      версии текста отбрасываются, поэтому медленные edit-вызовы не тормозят генерацию.
+    """
+    latest = {"text": "", "final": False}
+    event = asyncio.Event()
+
+    async def _writer():
+        next_edit_at = 0.0
+        while True:
+            await event.wait()
+            event.clear()
+
+            # Ждем окна редактирования: за это время текст в слоте успеет обновиться
+            now = asyncio.get_event_loop().time()
+            if not latest["final"] and now < next_edit_at:
+                await asyncio.sleep(next_edit_at - now)
+
+            text = latest["text"]
+            final = latest["final"]
+
+            if text:
+                try:
+                    await context.bot.edit_message_text(
+                        text,
+                        chat_id=placeholder_message.chat_id,
+                        message_id=placeholder_message.message_id,
+                        parse_mode=parse_mode,
+                    )
+                except telegram.error.BadRequest as e:
+                    if not _is_not_modified(e):
+                        await context.bot.edit_message_text(
+                            text,
+                            chat_id=placeholder_message.chat_id,
+                            message_id=placeholder_message.message_id,
+                        )
+
+                next_edit_at = asyncio.get_event_loop().time() + EDIT_INTERVAL
+
+            if final:
+                return
+
+    answer = ""
+    n_input_tokens, n_output_tokens = 0, 0
+    n_first_dialog_messages_removed = 0
+
+    writer_task = asyncio.create_task(_writer())
+    try:
+        async for gen_item in gen:
+            status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
+
+            # Кладем в слот самый свежий текст; срез делаем только при превышении лимита Telegram
+            latest["text"] = answer if len(answer) <= 4096 else answer[:4096]
+            latest["final"] = (status == "finished")
+            event.set()
+    finally:
+        # Гарантируем финальный сброс текста и завершение писателя даже при ошибке генерации
+        latest["final"] = True
+        event.set()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            writer_task.cancel()
+            raise
+
+    return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+
 def split_text_into_chunks(text, chunk_size):
     """
     Разбивает текст на части (chunk) заданного размера.
@@ -81,10 +472,13 @@ def split_text_into_chunks(text, chunk_size):
     chunk_size -- максимальный размер одного chunk
 
     Возвращает:
-    Генератор, возвращающий части текста длиной не более chunk_size символов.
+    Список частей текста длиной не более chunk_size символов.
     """
-    for i in range(0, len(text), chunk_size):
-        yield text[i:i + chunk_size]
+    # Частый случай: текст целиком помещается в один chunk
+    if len(text) <= chunk_size:
+        return [text]
+
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
 
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
@@ -96,51 +490,60 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
     context -- контекст, передаваемый в колбэк функции
     user -- объект User, представляющий текущего пользователя
     """
-    # Проверка наличия пользователя в базе данных
-    if not db.check_if_user_exists(user.id):
+    # Читаем документ пользователя целиком одним запросом вместо набора get_user_attribute
+    user_doc = await db.get_user_doc(user.id)
+
+    if user_doc is None:
         # Если пользователь не существует, добавляем его в базу данных
-        db.add_new_user(
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name=user.last_name
         )
-        db.start_new_dialog(user.id)  # Начинаем новый диалог для пользователя
+        await db.start_new_dialog(user.id)  # Начинаем новый диалог для пользователя
 
-    # Проверка наличия активного диалога для пользователя
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+        # Новый пользователь создан со всеми полями по умолчанию — дальше проверять нечего
+        _get_semaphore(user.id)
+        return
 
     # Инициализация семафора для пользователя, если он отсутствует
-    if user.id not in user_semaphores:
-        user_semaphores[user.id] = asyncio.Semaphore(1)
+    _get_semaphore(user.id)
+
+    # Проверка наличия активного диалога для пользователя
+    if user_doc.get("current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
+
+    # Собираем недостающие поля и записываем их одним update_one
+    to_set = {}
 
     # Установка модели по умолчанию для пользователя, если она не указана
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
+    if user_doc.get("current_model") is None:
+        to_set["current_model"] = config.models["available_text_models"][0]
 
     # Проверка обратной совместимости для поля n_used_tokens
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
+    n_used_tokens = user_doc.get("n_used_tokens")
     if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # старый формат
-        new_n_used_tokens = {
+        to_set["n_used_tokens"] = {
             "gpt-3.5-turbo": {
                 "n_input_tokens": 0,
                 "n_output_tokens": n_used_tokens
             }
         }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
 
     # Инициализация поля для транскрибированных секунд голосовых сообщений
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
+    if user_doc.get("n_transcribed_seconds") is None:
+        to_set["n_transcribed_seconds"] = 0.0
 
     # Инициализация поля для сгенерированных изображений
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
+    if user_doc.get("n_generated_images") is None:
+        to_set["n_generated_images"] = 0
 
+    await db.bulk_set_user_attributes(user.id, to_set)
 
-async def is_bot_mentioned(update: Update, context: CallbackContext):
+
+def is_bot_mentioned(update: Update, context: CallbackContext):
     """
     Проверяет, был ли упомянут бот в сообщении.
 
@@ -151,28 +554,61 @@ async def is_bot_mentioned(update: Update, context: CallbackContext):
     Возвращает:
     True, если бот был упомянут, иначе False.
     """
-    try:
-        message = update.message
+    message = update.message
+    if message is None:
+        return False
 
-        # Если сообщение в приватном чате, бот всегда считается упомянутым
-        if message.chat.type == "private":
-            return True
+    # Если сообщение в приватном чате, бот всегда считается упомянутым
+    if message.chat.type == "private":
+        return True
 
-        # Проверка на наличие упоминания бота по username в тексте сообщения
-        if message.text is not None and ("@" + context.bot.username) in message.text:
+    # Проверка на наличие упоминания бота по username в тексте сообщения
+    mention = BOT_USERNAME_AT or ("@" + context.bot.username)
+    if message.text is not None and mention in message.text:
+        return True
+
+    # Проверка, является ли сообщение ответом на сообщение бота
+    reply_to = message.reply_to_message
+    if reply_to is not None and reply_to.from_user is not None:
+        if reply_to.from_user.id == context.bot.id:
             return True
 
-        # Проверка, является ли сообщение ответом на сообщение бота
-        if message.reply_to_message is not None:
-            if message.reply_to_message.from_user.id == context.bot.id:
-                return True
-    except:
-        # В случае исключения считаем, что бот упомянут
-        return True
-    else:
-        return False
+    return False
+
+
+def with_user_context(check_busy: bool = True):
+    """
+    Декоратор общего пролога обработчиков: регистрация пользователя, проверка
+    незавершенного запроса и отметка времени последнего взаимодействия.
+
+    Аргументы:
+    check_busy -- проверять ли, что предыдущий запрос пользователя уже обработан.
+
+    Описание:
+    - Работает и с обычными сообщениями, и с callback-запросами.
+    - last_interaction пишется в буфер отложенной записи, а не напрямую в базу.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+            if update.callback_query is not None:
+                target, user = update.callback_query, update.callback_query.from_user
+            else:
+                target, user = update, update.message.from_user
+
+            await register_user_if_not_exists(target, context, user)
+            if check_busy and await is_previous_message_not_answered_yet(target, context):
+                return
+
+            _last_interaction_buf[user.id] = int(time.time())
+            return await fn(update, context, *args, **kwargs)
+
+        return wrapper
 
+    return decorator
 
+
+@with_user_context(check_busy=False)
 async def start_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает команду /start, регистрирует пользователя и отправляет приветственное сообщение.
@@ -181,13 +617,8 @@ async def start_handle(update: Update, context: CallbackContext):
     update -- объект Update, содержащий данные о текущем обновлении
     context -- контекст, передаваемый в колбэк функции
     """
-    # Регистрация пользователя, если он не существует
-    await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-
-    # Обновление времени последнего взаимодействия пользователя
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)  # Начало нового диалога
+    await db.start_new_dialog(user_id)  # Начало нового диалога
 
     # Формирование приветственного сообщения
     reply_text = "Hi! I'm <b>ChatGPT</b> bot implemented with OpenAI API 🤖\n\n"
@@ -198,6 +629,7 @@ async def start_handle(update: Update, context: CallbackContext):
     await show_chat_modes_handle(update, context)
 
 
+@with_user_context(check_busy=False)
 async def help_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает команду /help, регистрирует пользователя и отправляет сообщение с доступными командами.
@@ -206,12 +638,10 @@ async def help_handle(update: Update, context: CallbackContext):
     update -- объект Update, содержащий данные о текущем обновлении
     context -- контекст, передаваемый в колбэк функции
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)  # Регистрация пользователя
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())  # Обновление времени последнего взаимодействия
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)  # Отправка сообщения с командами
 
 
+@with_user_context(check_busy=False)
 async def help_group_chat_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает команду /help_group_chat, регистрирует пользователя и отправляет инструкции по добавлению бота в групповой чат.
@@ -220,10 +650,6 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
     update -- объект Update, содержащий данные о текущем обновлении
     context -- контекст, передаваемый в колбэк функции
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)  # Регистрация пользователя
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())  # Обновление времени последнего взаимодействия
-
     # Формирование сообщения с инструкциями
     text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
 
@@ -232,6 +658,7 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
     await update.message.reply_video(config.help_group_chat_video_path)
 
 
+@with_user_context()
 async def retry_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает команду /retry, повторяет последний запрос пользователя.
@@ -240,15 +667,11 @@ async def retry_handle(update: Update, context: CallbackContext):
     update -- объект Update, содержащий данные о текущем обновлении
     context -- контекст, передаваемый в колбэк функции
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)  # Регистрация пользователя
-    if await is_previous_message_not_answered_yet(update,
-                                                  context): return  # Проверка, был ли предыдущий запрос обработан
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())  # Обновление времени последнего взаимодействия
 
-    # Получение сообщений диалога пользователя
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+    # Дожидаемся фоновой инициализации диалога и получаем его сообщения
+    await _await_dialog_init(user_id)
+    dialog_messages = await db.get_dialog_messages(user_id, dialog_id=None)
     if len(dialog_messages) == 0:
         # Если сообщений нет, отправляется соответствующее сообщение
         await update.message.reply_text("Нет сообщения для повторной попытки 🤷‍♂️")
@@ -256,7 +679,7 @@ async def retry_handle(update: Update, context: CallbackContext):
 
     # Извлечение последнего сообщения из диалога
     last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages,
+    await db.set_dialog_messages(user_id, dialog_messages,
                            dialog_id=None)  # Удаление последнего сообщения из контекста диалога
 
     # Повторная обработка последнего сообщения
@@ -276,29 +699,38 @@ async def _vision_message_handle_fn(
     """
     logger.info('_vision_message_handle_fn')  # Логирование начала обработки
     user_id = update.message.from_user.id  # Идентификатор пользователя
-    current_model = db.get_user_attribute(user_id, "current_model")  # Текущая модель, используемая пользователем
+    current_model = await db.get_user_attribute(user_id, "current_model")  # Текущая модель, используемая пользователем
 
     # Проверка, поддерживает ли текущая модель обработку изображений
-    if current_model != "gpt-4-vision-preview" and current_model != "gpt-4o":
+    if current_model not in VISION_MODELS:
         await update.message.reply_text(
             "🥲 Обработка изображений доступна только для моделей <b>gpt-4-vision-preview</b> и <b>gpt-4o</b>. Пожалуйста, измените настройки в /settings",
             parse_mode=ParseMode.HTML,
         )
         return
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")  # Текущий режим чата пользователя
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")  # Текущий режим чата пользователя
+
+    # Получаем сообщения текущего диалога один раз и переиспользуем их ниже
+    # (предварительно дождавшись фоновой инициализации нового диалога, если она идет)
+    await _await_dialog_init(user_id)
+    dialog_messages = await db.get_dialog_messages(user_id, dialog_id=None)
 
     # Проверка тайм-аута для нового диалога
     if use_new_dialog_timeout:
-        last_interaction = db.get_user_attribute(user_id, "last_interaction")
-        if (datetime.now() - last_interaction).seconds > config.new_dialog_timeout and len(
-                db.get_dialog_messages(user_id)) > 0:
-            db.start_new_dialog(user_id)  # Начинаем новый диалог при истечении тайм-аута
+        last_interaction = _last_interaction_buf.get(user_id)
+        if last_interaction is None:
+            last_interaction = await db.get_user_attribute(user_id, "last_interaction")
+        if isinstance(last_interaction, datetime):  # старый формат (datetime вместо unix-времени)
+            last_interaction = last_interaction.timestamp()
+        if time.time() - last_interaction > config.new_dialog_timeout and len(dialog_messages) > 0:
+            await db.start_new_dialog(user_id)  # Начинаем новый диалог при истечении тайм-аута
+            dialog_messages = []
             await update.message.reply_text(
                 f"Начинаем новый диалог из-за тайм-аута (<b>{config.chat_modes[chat_mode]['name']}</b> режим) ✅",
                 parse_mode=ParseMode.HTML)
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())  # Обновляем время последнего взаимодействия
+    _last_interaction_buf[user_id] = int(time.time())  # Обновляем время последнего взаимодействия
 
     buf = None
     if update.message.effective_attachment:
@@ -319,14 +751,9 @@ async def _vision_message_handle_fn(
         placeholder_message = await update.message.reply_text("...")
         message = update.message.caption or update.message.text or ''
 
-        # Отправляем действие "печатает"
-        await update.message.chat.send_action(action="typing")
-
-        dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)  # Получаем сообщения текущего диалога
-        parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
-            config.chat_modes[chat_mode]["parse_mode"]]  # Определяем режим парсинга
+        parse_mode = PARSE_MODE_MAP[config.chat_modes[chat_mode]["parse_mode"]]  # Определяем режим парсинга
 
-        chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+        chatgpt_instance = get_chatgpt(current_model)
         if config.enable_message_streaming:
             # Если включен потоковый режим, отправляем сообщение с изображением с потоковой обработкой
             gen = chatgpt_instance.send_vision_message_stream(
@@ -356,46 +783,21 @@ async def _vision_message_handle_fn(
 
             gen = fake_gen()  # Генерация фейкового генератора для работы с синхронным кодом
 
-        prev_answer = ""
-        async for gen_item in gen:
+        # Держим индикатор "печатает" на всё время генерации
+        async with TypingKeeper(context.bot, update.message.chat_id):
             (
-                status,
                 answer,
                 (n_input_tokens, n_output_tokens),
                 n_first_dialog_messages_removed,
-            ) = gen_item
-
-            answer = answer[:4096]  # Ограничение на длину сообщения в Telegram
-
-            # Обновляем сообщение, только если добавилось более 100 символов или генерация завершена
-            if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                continue
-
-            try:
-                await context.bot.edit_message_text(
-                    answer,
-                    chat_id=placeholder_message.chat_id,
-                    message_id=placeholder_message.message_id,
-                    parse_mode=parse_mode,
-                )
-            except telegram.error.BadRequest as e:
-                if str(e).startswith("Message is not modified"):
-                    continue
-                else:
-                    await context.bot.edit_message_text(
-                        answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                    )
-
-            await asyncio.sleep(0.01)  # Небольшая пауза для избежания ограничения на количество запросов
-
-            prev_answer = answer
+            ) = await _stream_answer_to_message(context, placeholder_message, parse_mode, gen)
 
         answer = ""
         # Обновляем данные пользователя
         if buf is not None:
-            base_image = base64.b64encode(buf.getvalue()).decode("utf-8")
+            # Сохраняем изображение в GridFS, в диалоге остается только его идентификатор.
+            # ObjectId храним строкой: документ диалога попадает в историю промпта,
+            # и все его части должны быть JSON-сериализуемыми.
+            image_id = await db.put_image(buf.getbuffer())
             new_dialog_message = {"user": [
                 {
                     "type": "text",
@@ -403,25 +805,19 @@ async def _vision_message_handle_fn(
                 },
                 {
                     "type": "image",
-                    "image": base_image,
+                    "image_id": str(image_id),
                 }
             ]
-                , "bot": answer, "date": datetime.now()}
+                , "bot": answer, "date": datetime.now(_UTC)}
         else:
-            new_dialog_message = {"user": [{"type": "text", "text": message}], "bot": answer, "date": datetime.now()}
+            new_dialog_message = {"user": [{"type": "text", "text": message}], "bot": answer, "date": datetime.now(_UTC)}
 
-        db.set_dialog_messages(
-            user_id,
-            db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-            dialog_id=None
-        )
-
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens,
-                                n_output_tokens)  # Обновляем количество использованных токенов
+        # Сохраняем сообщение и статистику токенов параллельно одним вызовом
+        await db.finalize_turn(user_id, new_dialog_message, current_model, n_input_tokens, n_output_tokens)
 
     except asyncio.CancelledError:
         # В случае ошибки отмены, обновляем количество использованных токенов
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
         raise
 
     except Exception as e:
@@ -456,15 +852,16 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     message -- текстовое сообщение пользователя (по умолчанию None)
     use_new_dialog_timeout -- флаг, указывающий, нужно ли проверять тайм-аут для нового диалога (по умолчанию True)
     """
-    # Проверяем, упомянут ли бот (актуально для групповых чатов)
-    if not await is_bot_mentioned(update, context):
-        return
-
-    # Проверяем, было ли сообщение отредактировано
+    # Проверяем, было ли сообщение отредактировано (до проверки упоминания:
+    # у таких апдейтов update.message пуст, и is_bot_mentioned вернул бы False)
     if update.edited_message is not None:
         await edited_message_handle(update, context)
         return
 
+    # Проверяем, упомянут ли бот (актуально для групповых чатов)
+    if not is_bot_mentioned(update, context):
+        return
+
     _message = message or update.message.text  # Используем переданное сообщение или текст из update
 
     # Удаляем упоминание бота (для групповых чатов)
@@ -477,14 +874,14 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                                                   context): return  # Проверка, был ли предыдущий запрос обработан
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")  # Получаем текущий режим чата пользователя
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")  # Получаем текущий режим чата пользователя
 
     # Если режим чата "artist", обрабатываем сообщение как запрос на генерацию изображения
     if chat_mode == "artist":
         await generate_image_handle(update, context, message=message)
         return
 
-    current_model = db.get_user_attribute(user_id, "current_model")  # Получаем текущую модель пользователя
+    current_model = await db.get_user_attribute(user_id, "current_model")  # Получаем текущую модель пользователя
 
     async def message_handle_fn():
         """
@@ -492,16 +889,26 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         """
         answer = ''
         n_first_dialog_messages_removed = 0
+
+        # Получаем сообщения текущего диалога один раз и переиспользуем их ниже
+        # (предварительно дождавшись фоновой инициализации нового диалога, если она идет)
+        await _await_dialog_init(user_id)
+        dialog_messages = await db.get_dialog_messages(user_id, dialog_id=None)
+
         # Проверка тайм-аута для нового диалога
         if use_new_dialog_timeout:
-            last_interaction = db.get_user_attribute(user_id, "last_interaction")
-            if (datetime.now() - last_interaction).seconds > config.new_dialog_timeout and len(
-                    db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+            last_interaction = _last_interaction_buf.get(user_id)
+            if last_interaction is None:
+                last_interaction = await db.get_user_attribute(user_id, "last_interaction")
+            if isinstance(last_interaction, datetime):  # старый формат (datetime вместо unix-времени)
+                last_interaction = last_interaction.timestamp()
+            if time.time() - last_interaction > config.new_dialog_timeout and len(dialog_messages) > 0:
+                await db.start_new_dialog(user_id)
+                dialog_messages = []
                 await update.message.reply_text(
                     f"Начинаем новый диалог из-за тайм-аута (<b>{config.chat_modes[chat_mode]['name']}</b> режим) ✅",
                     parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())  # Обновляем время последнего взаимодействия
+        _last_interaction_buf[user_id] = int(time.time())  # Обновляем время последнего взаимодействия
 
         # В случае ошибки CancelledError
         n_input_tokens, n_output_tokens = 0, 0
@@ -510,21 +917,14 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             # Отправляем пользователю сообщение-заполнитель
             placeholder_message = await update.message.reply_text("...")
 
-            # Отправляем действие "печатает"
-            await update.message.chat.send_action(action="typing")
-
             if _message is None or len(_message) == 0:
                 await update.message.reply_text("🥲 Вы отправили <b>пустое сообщение</b>. Попробуйте снова!",
                                                 parse_mode=ParseMode.HTML)
                 return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)  # Получаем сообщения текущего диалога
-            parse_mode = {
-                "html": ParseMode.HTML,
-                "markdown": ParseMode.MARKDOWN
-            }[config.chat_modes[chat_mode]["parse_mode"]]  # Определяем режим парсинга
+            parse_mode = PARSE_MODE_MAP[config.chat_modes[chat_mode]["parse_mode"]]  # Определяем режим парсинга
 
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
+            chatgpt_instance = get_chatgpt(current_model)
             if config.enable_message_streaming:
                 # Если включен потоковый режим, отправляем сообщение с потоковой обработкой
                 gen = chatgpt_instance.send_message_stream(_message, dialog_messages=dialog_messages,
@@ -544,47 +944,23 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
 
                 gen = fake_gen()  # Генерация фейкового генератора для работы с синхронным кодом
 
-            prev_answer = ""
-
-            async for gen_item in gen:
-                status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
-
-                answer = answer[:4096]  # Ограничение на длину сообщения в Telegram
-
-                # Обновляем сообщение, только если добавилось более 100 символов или генерация завершена
-                if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
-
-                try:
-                    await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id,
-                                                        message_id=placeholder_message.message_id,
-                                                        parse_mode=parse_mode)
-                except telegram.error.BadRequest as e:
-                    if str(e).startswith("Message is not modified"):
-                        continue
-                    else:
-                        await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id,
-                                                            message_id=placeholder_message.message_id)
-
-                await asyncio.sleep(0.01)  # Небольшая пауза для избежания ограничения на количество запросов
-
-                prev_answer = answer
+            # Держим индикатор "печатает" на всё время генерации
+            async with TypingKeeper(context.bot, update.message.chat_id):
+                (
+                    answer,
+                    (n_input_tokens, n_output_tokens),
+                    n_first_dialog_messages_removed,
+                ) = await _stream_answer_to_message(context, placeholder_message, parse_mode, gen)
 
             # Обновляем данные пользователя
-            new_dialog_message = {"user": [{"type": "text", "text": _message}], "bot": answer, "date": datetime.now()}
+            new_dialog_message = {"user": [{"type": "text", "text": _message}], "bot": answer, "date": datetime.now(_UTC)}
 
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None
-            )
-
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens,
-                                    n_output_tokens)  # Обновляем количество использованных токенов
+            # Сохраняем сообщение и статистику токенов параллельно одним вызовом
+            await db.finalize_turn(user_id, new_dialog_message, current_model, n_input_tokens, n_output_tokens)
 
         except asyncio.CancelledError:
             # В случае ошибки отмены, обновляем количество использованных токенов
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
             raise
 
         except Exception as e:
@@ -601,21 +977,20 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 text = f"✍️ <i>Примечание:</i> Ваш текущий диалог слишком длинный, поэтому <b>{n_first_dialog_messages_removed} первых сообщений</b> были удалены из контекста.\n Отправьте команду /new, чтобы начать новый диалог"
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    async with user_semaphores[user_id]:  # Блокируем выполнение для пользователя до завершения текущей задачи
-        if current_model == "gpt-4-vision-preview" or current_model == "gpt-4o" or update.message.photo is not None and len(
-                update.message.photo) > 0:
-
-            logger.error(current_model)
-            # Проверка текущей модели
+    async with _get_semaphore(user_id):  # Блокируем выполнение для пользователя до завершения текущей задачи
+        has_photo = bool(update.message.photo)
+        is_vision_model = current_model in VISION_MODELS
 
-            if current_model != "gpt-4o" and current_model != "gpt-4-vision-preview":
+        if has_photo or is_vision_model:
+            # Переключаем модель (и пишем в базу) только если она еще не поддерживает изображения
+            if not is_vision_model:
                 current_model = "gpt-4o"
-                db.set_user_attribute(user_id, "current_model", "gpt-4o")
-            task = asyncio.create_task(
+                await db.set_user_attribute(user_id, "current_model", current_model)
+            task = spawn(
                 _vision_message_handle_fn(update, context, use_new_dialog_timeout=use_new_dialog_timeout)
             )
         else:
-            task = asyncio.create_task(
+            task = spawn(
                 message_handle_fn()
             )
 
@@ -650,7 +1025,7 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    if user_semaphores[user_id].locked():
+    if _get_semaphore(user_id).locked():
         text = "⏳ Пожалуйста, <b>дождитесь</b> ответа на предыдущее сообщение.\n"
         text += "Или ты можешь отменить /cancel"
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
@@ -671,7 +1046,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     - context: объект CallbackContext, предоставляющий контекст выполнения.
     """
     # Проверяет, упомянут ли бот (для групповых чатов)
-    if not await is_bot_mentioned(update, context):
+    if not is_bot_mentioned(update, context):
         return
 
     await register_user_if_not_exists(update, context, update.message.from_user)
@@ -679,7 +1054,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    _last_interaction_buf[user_id] = int(time.time())
 
     # Получаем голосовое сообщение и файл
     voice = update.message.voice
@@ -697,13 +1072,14 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # Обновляем количество транскрибированных секунд
-    db.set_user_attribute(user_id, "n_transcribed_seconds",
-                          voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    await db.set_user_attribute(user_id, "n_transcribed_seconds",
+                          voice.duration + await db.get_user_attribute(user_id, "n_transcribed_seconds"))
 
     # Передаем транскрибированный текст для дальнейшей обработки
     await message_handle(update, context, message=transcribed_text)
 
 
+@with_user_context()
 async def generate_image_handle(update: Update, context: CallbackContext, message=None):
     """
     Обрабатывает запрос на генерацию изображения на основе текстового сообщения пользователя.
@@ -716,40 +1092,56 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     - context: объект CallbackContext, предоставляющий контекст выполнения.
     - message: необязательный аргумент, содержащий текст запроса для генерации изображения.
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context):
-        return
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     # Устанавливаем статус "загрузка фото"
     await update.message.chat.send_action(action="upload_photo")
 
     message = message or update.message.text
 
-    try:
-        # Генерируем изображения с помощью OpenAI
-        image_urls = await openai_utils.generate_images(message, n_images=config.return_n_generated_images,
-                                                        size=config.image_size)
-    except openai.error.InvalidRequestError as e:
-        if str(e).startswith("Your request was rejected as a result of our safety system"):
-            text = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies.\nWhat did you write there, huh?"
-            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
-            return
-        else:
-            raise
+    # Проверяем кеш результатов: повторный запрос не должен заново звать API
+    cache_key = None
+    image_urls = None
+    if config.image_cache_ttl > 0:
+        cache_key = hashlib.sha256(
+            f"{message}|{config.image_size}|{config.return_n_generated_images}".encode()
+        ).hexdigest()
+        cached = _image_cache.get(cache_key)
+        if cached is not None and cached[0] > time.monotonic():
+            image_urls = cached[1]
+
+    if image_urls is None:
+        try:
+            # Генерируем изображения с помощью OpenAI
+            image_urls = await openai_utils.generate_images(message, n_images=config.return_n_generated_images,
+                                                            size=config.image_size)
+        except openai.error.InvalidRequestError as e:
+            if _is_safety_rejection(e):
+                await update.message.reply_text(SAFETY_REJECTION_TEXT, parse_mode=ParseMode.HTML)
+                return
+            else:
+                raise
+
+        if cache_key is not None:
+            if len(_image_cache) >= _IMAGE_CACHE_MAX_SIZE:
+                _image_cache.pop(next(iter(_image_cache)), None)
+            _image_cache[cache_key] = (time.monotonic() + config.image_cache_ttl, image_urls)
 
-    # Обновляем статистику использования токенов
-    db.set_user_attribute(user_id, "n_generated_images",
-                          config.return_n_generated_images + db.get_user_attribute(user_id, "n_generated_images"))
+        # Обновляем статистику использования токенов (только реально сгенерированные изображения)
+        await db.set_user_attribute(user_id, "n_generated_images",
+                              config.return_n_generated_images + await db.get_user_attribute(user_id, "n_generated_images"))
 
-    # Отправляем сгенерированные изображения
-    for i, image_url in enumerate(image_urls):
-        await update.message.chat.send_action(action="upload_photo")
-        await update.message.reply_photo(image_url, parse_mode=ParseMode.HTML)
+    # Отправляем сгенерированные изображения параллельно (статус уже установлен выше)
+    results = await asyncio.gather(
+        *(update.message.reply_photo(image_url, parse_mode=ParseMode.HTML) for image_url in image_urls),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Не удалось отправить сгенерированное изображение: %s", result)
 
 
+@with_user_context()
 async def new_dialog_handle(update: Update, context: CallbackContext):
     """
     Начинает новый диалог с пользователем, сбрасывая текущее состояние диалога.
@@ -760,23 +1152,22 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
     - update: объект Update, представляющий текущее обновление.
     - context: объект CallbackContext, предоставляющий контекст выполнения.
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context):
-        return
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.set_user_attribute(user_id, "current_model", "gpt-3.5-turbo")
-
-    # Начинаем новый диалог
-    db.start_new_dialog(user_id)
-    await update.message.reply_text("Начало нового диалога ✅")
+    await db.set_user_attribute(user_id, "current_model", "gpt-3.5-turbo")
+
+    # Начинаем новый диалог в фоне: ответ пользователю не зависит от записи в базу,
+    # а обработчики сообщений дождутся инициализации через _await_dialog_init
+    _spawn_dialog_init(user_id)
+    _, chat_mode = await asyncio.gather(
+        update.message.reply_text("Начало нового диалога ✅"),
+        db.get_user_attribute(user_id, "current_chat_mode"),
+    )
 
     # Отправляем приветственное сообщение для выбранного режима общения
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    await update.message.reply_text(f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
+    await update.message.reply_text(_WELCOME[chat_mode], parse_mode=ParseMode.HTML)
 
 
+@with_user_context(check_busy=False)
 async def cancel_handle(update: Update, context: CallbackContext):
     """
     Отменяет текущую задачу пользователя, если таковая существует.
@@ -787,10 +1178,7 @@ async def cancel_handle(update: Update, context: CallbackContext):
     - update: объект Update, представляющий текущее обновление.
     - context: объект CallbackContext, предоставляющий контекст выполнения.
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
@@ -811,11 +1199,13 @@ def get_chat_mode_menu(page_index: int):
     - reply_markup: объект InlineKeyboardMarkup, содержащий кнопки для выбора режимов и навигации.
     """
     n_chat_modes_per_page = config.n_chat_modes_per_page
-    text = f"Select <b>chat mode</b> ({len(config.chat_modes)} modes available):"
+    n_chat_modes = len(config.chat_modes)
+    text = f"Select <b>chat mode</b> ({n_chat_modes} modes available):"
 
-    # Кнопки выбора режима
-    chat_mode_keys = list(config.chat_modes.keys())
-    page_chat_mode_keys = chat_mode_keys[page_index * n_chat_modes_per_page:(page_index + 1) * n_chat_modes_per_page]
+    # Кнопки выбора режима: берем нужный срез ключей без копирования всего списка
+    page_chat_mode_keys = itertools.islice(
+        config.chat_modes, page_index * n_chat_modes_per_page, (page_index + 1) * n_chat_modes_per_page
+    )
 
     keyboard = []
     for chat_mode_key in page_chat_mode_keys:
@@ -823,9 +1213,9 @@ def get_chat_mode_menu(page_index: int):
         keyboard.append([InlineKeyboardButton(name, callback_data=f"set_chat_mode|{chat_mode_key}")])
 
     # Пагинация (переход между страницами)
-    if len(chat_mode_keys) > n_chat_modes_per_page:
+    if n_chat_modes > n_chat_modes_per_page:
         is_first_page = (page_index == 0)
-        is_last_page = ((page_index + 1) * n_chat_modes_per_page >= len(chat_mode_keys))
+        is_last_page = ((page_index + 1) * n_chat_modes_per_page >= n_chat_modes)
 
         if is_first_page:
             keyboard.append([
@@ -846,6 +1236,15 @@ def get_chat_mode_menu(page_index: int):
     return text, reply_markup
 
 
+# Страницы меню режимов зависят только от индекса страницы, поэтому рендерим их
+# один раз при загрузке модуля вместо пересборки кнопок на каждый callback
+_CHAT_MODE_PAGES = {
+    page_index: get_chat_mode_menu(page_index)
+    for page_index in range((len(config.chat_modes) + config.n_chat_modes_per_page - 1) // config.n_chat_modes_per_page)
+}
+
+
+@with_user_context()
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает команду для отображения меню выбора режима общения с поддержкой пагинации.
@@ -859,17 +1258,11 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     - Проверяет, был ли предыдущий запрос пользователя обработан.
     - Отправляет пользователю меню выбора режима общения с начальной страницей (индекс 0).
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context):
-        return
-
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    text, reply_markup = get_chat_mode_menu(0)
+    text, reply_markup = _CHAT_MODE_PAGES[0]
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@with_user_context()
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает нажатие кнопок навигации в меню выбора режимов общения.
@@ -883,13 +1276,6 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
     - Проверяет, был ли предыдущий запрос пользователя обработан.
     - Определяет индекс страницы для отображения и обновляет меню выбора режима общения.
     """
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    if await is_previous_message_not_answered_yet(update.callback_query, context):
-        return
-
-    user_id = update.callback_query.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
     query = update.callback_query
     await query.answer()
 
@@ -898,15 +1284,19 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
     if page_index < 0:
         return
 
-    text, reply_markup = get_chat_mode_menu(page_index)
+    page = _CHAT_MODE_PAGES.get(page_index)
+    if page is None:
+        return
+    text, reply_markup = page
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
         # Если сообщение не было изменено (Message is not modified), ничего не делаем
-        if str(e).startswith("Message is not modified"):
+        if _is_not_modified(e):
             pass
 
 
+@with_user_context(check_busy=False)
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает выбор режима общения пользователя из меню.
@@ -920,44 +1310,45 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     - Устанавливает выбранный режим общения и начинает новый диалог.
     - Отправляет пользователю приветственное сообщение для выбранного режима.
     """
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
-
     query = update.callback_query
-    await query.answer()
 
-    # Устанавливаем выбранный режим общения
+    # Устанавливаем выбранный режим общения; подтверждение callback'а
+    # и запись в базу независимы, выполняем их параллельно
     chat_mode = query.data.split("|")[1]
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await asyncio.gather(
+        query.answer(),
+        db.set_user_attribute(user_id, "current_chat_mode", chat_mode),
+    )
 
+    # Диалог инициализируется в фоне, приветствие уходит сразу
+    _spawn_dialog_init(user_id)
     await context.bot.send_message(
         update.callback_query.message.chat.id,
-        f"{config.chat_modes[chat_mode]['welcome_message']}",
+        _WELCOME[chat_mode],
         parse_mode=ParseMode.HTML
     )
 
 
-def get_settings_menu(user_id: int):
+def get_settings_menu_for_model(current_model: str):
     """
-    Создает меню настроек для выбора модели.
+    Рендерит меню настроек для заданной текущей модели.
 
     Аргументы:
-    - user_id: идентификатор пользователя.
+    - current_model: название текущей модели пользователя.
 
     Возвращает:
     - text: текст сообщения с текущими настройками и доступными моделями.
     - reply_markup: объект InlineKeyboardMarkup, содержащий кнопки для выбора модели.
-    """
-    current_model = db.get_user_attribute(user_id, "current_model")
-    text = config.models["info"][current_model]["description"]
 
-    text += "\n\n"
-    score_dict = config.models["info"][current_model]["scores"]
-    for score_key, score_value in score_dict.items():
-        text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
-
-    text += "\nВыберите <b>модель</b>:"
+    Описание:
+    - Меню зависит только от текущей модели, поэтому результат можно кешировать
+      по ее названию (_SETTINGS_MENUS).
+    """
+    model_text = _MODEL_TEXT.get(current_model)
+    if model_text is None:
+        model_text = _render_model_text(current_model)
+    text = model_text + "\nВыберите <b>модель</b>:"
 
     # Кнопки для выбора модели
     buttons = []
@@ -977,6 +1368,55 @@ def get_settings_menu(user_id: int):
     return text, reply_markup
 
 
+def _render_model_text(model_key: str) -> str:
+    """
+    Рендерит описание модели и полоски оценок из статичной конфигурации.
+
+    Аргументы:
+    - model_key: название модели из config.models["info"].
+    """
+    text = config.models["info"][model_key]["description"]
+
+    text += "\n\n"
+    score_dict = config.models["info"][model_key]["scores"]
+    for score_key, score_value in score_dict.items():
+        text += "🟢" * score_value + "⚪️" * (5 - score_value) + f" – {score_key}\n\n"
+
+    return text
+
+
+# Описания моделей и полоски оценок статичны - рендерим их один раз при загрузке модуля
+# (только текстовые модели: у dalle-2/whisper нет описания и оценок)
+_MODEL_TEXT = {model_key: _render_model_text(model_key) for model_key in config.models["available_text_models"]}
+
+
+# Меню настроек зависит только от текущей модели (маленькое множество),
+# поэтому рендерим вариант для каждой модели один раз при загрузке модуля
+_SETTINGS_MENUS = {
+    model_key: get_settings_menu_for_model(model_key)
+    for model_key in config.models["available_text_models"]
+}
+
+
+async def get_settings_menu(user_id: int):
+    """
+    Возвращает меню настроек для текущей модели пользователя.
+
+    Аргументы:
+    - user_id: идентификатор пользователя.
+
+    Возвращает:
+    - text: текст сообщения с текущими настройками и доступными моделями.
+    - reply_markup: объект InlineKeyboardMarkup, содержащий кнопки для выбора модели.
+    """
+    current_model = await db.get_user_attribute(user_id, "current_model")
+    menu = _SETTINGS_MENUS.get(current_model)
+    if menu is None:
+        menu = get_settings_menu_for_model(current_model)
+    return menu
+
+
+@with_user_context()
 async def settings_handle(update: Update, context: CallbackContext):
     """
     Отправляет пользователю меню настроек для выбора модели.
@@ -989,17 +1429,13 @@ async def settings_handle(update: Update, context: CallbackContext):
     - Проверяет, зарегистрирован ли пользователь. Если нет, регистрирует.
     - Отправляет пользователю текст с текущими настройками и кнопки для выбора модели.
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    if await is_previous_message_not_answered_yet(update, context):
-        return
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@with_user_context(check_busy=False)
 async def set_settings_handle(update: Update, context: CallbackContext):
     """
     Обрабатывает выбор модели из меню настроек.
@@ -1013,25 +1449,28 @@ async def set_settings_handle(update: Update, context: CallbackContext):
     - Устанавливает выбранную модель и начинает новый диалог.
     - Обновляет меню настроек с новой выбранной моделью.
     """
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
-
     query = update.callback_query
-    await query.answer()
 
+    # Подтверждение callback'а и запись выбранной модели независимы
     _, model_key = query.data.split("|")
-    db.set_user_attribute(user_id, "current_model", model_key)
-    db.start_new_dialog(user_id)
+    await asyncio.gather(
+        query.answer(),
+        db.set_user_attribute(user_id, "current_model", model_key),
+    )
 
-    text, reply_markup = get_settings_menu(user_id)
+    # Диалог инициализируется в фоне, меню обновляется сразу
+    _spawn_dialog_init(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
         # Если сообщение не было изменено (Message is not modified), ничего не делаем
-        if str(e).startswith("Message is not modified"):
+        if _is_not_modified(e):
             pass
 
 
+@with_user_context(check_busy=False)
 async def show_balance_handle(update: Update, context: CallbackContext):
     """
     Показывает пользователю статистику баланса, включая расходы на токены и изображения.
@@ -1044,18 +1483,19 @@ async def show_balance_handle(update: Update, context: CallbackContext):
     - Проверяет, зарегистрирован ли пользователь. Если нет, регистрирует.
     - Считает и отображает общую статистику расходов, включая использование токенов и генерацию изображений.
     """
-    await register_user_if_not_exists(update, context, update.message.from_user)
-
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     # Подсчет общей статистики использования
     total_n_spent_dollars = 0
     total_n_used_tokens = 0
 
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
+    # Читаем всю статистику одним запросом вместо трех round-trip
+    usage = await db.get_user_attributes(
+        user_id, ["n_used_tokens", "n_generated_images", "n_transcribed_seconds"]
+    )
+    n_used_tokens_dict = usage["n_used_tokens"]
+    n_generated_images = usage["n_generated_images"]
+    n_transcribed_seconds = usage["n_transcribed_seconds"]
 
     details_text = "🏷️ Подробности:\n"
     for model_key in sorted(n_used_tokens_dict.keys()):
@@ -1109,6 +1549,35 @@ async def edited_message_handle(update: Update, context: CallbackContext):
         await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
+def _format_error(update, error) -> list:
+    """
+    Синхронно форматирует дамп ошибки и режет его на куски по 4096 символов.
+
+    Аргументы:
+    - update: объект Update (или его строковое представление), вызвавший ошибку.
+    - error: возникшее исключение.
+
+    Возвращает:
+    - Список строк, готовых к отправке в Telegram.
+
+    Описание:
+    - Вызывается из error_handle через run_in_executor: форматирование длинных
+      traceback'ов и JSON-дампа не должно блокировать event loop.
+    """
+    tb_list = traceback.format_exception(None, error, error.__traceback__)
+    tb_string = "".join(tb_list)
+    update_str = update.to_dict() if isinstance(update, Update) else str(update)
+    message = (
+        f"Произошло исключение при обработке обновления\n"
+        f"<pre>update = {html.escape(_json_dumps(update_str, indent=True))}"
+        "</pre>\n\n"
+        f"<pre>{html.escape(tb_string)}</pre>"
+    )
+
+    # Простая нарезка срезами, без пересканирования строки
+    return split_text_into_chunks(message, 4096)
+
+
 async def error_handle(update: Update, context: CallbackContext) -> None:
     """
     Обрабатывает ошибки, возникшие при обработке обновлений.
@@ -1123,20 +1592,21 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
     """
     logger.error(msg="Исключение при обработке обновления:", exc_info=context.error)
 
+    # Если отправлять сообщение некуда, не тратим время на сборку дампа
+    if update is None or update.effective_chat is None:
+        return
+
     try:
-        # Собираем сообщение об ошибке
-        tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-        tb_string = "".join(tb_list)
-        update_str = update.to_dict() if isinstance(update, Update) else str(update)
-        message = (
-            f"Произошло исключение при обработке обновления\n"
-            f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
-            "</pre>\n\n"
-            f"<pre>{html.escape(tb_string)}</pre>"
+        # Форматирование дампа (traceback, JSON, html.escape) - чистый CPU-код;
+        # выносим его в поток, чтобы не блокировать event loop во время шторма ошибок
+        # run_in_executor, а не asyncio.to_thread: образ собирается на python:3.8,
+        # где to_thread еще не существует
+        message_chunks = await asyncio.get_running_loop().run_in_executor(
+            None, _format_error, update, context.error
         )
 
-        # Разделяем текст на несколько сообщений из-за ограничения на 4096 символов
-        for message_chunk in split_text_into_chunks(message, 4096):
+        # Отправляем частями из-за ограничения на 4096 символов
+        for message_chunk in message_chunks:
             try:
                 await context.bot.send_message(update.effective_chat.id, message_chunk, parse_mode=ParseMode.HTML)
             except telegram.error.BadRequest:
@@ -1156,6 +1626,24 @@ async def post_init(application: Application):
     Описание:
     - Устанавливает список команд бота и их описание.
     """
+    # Кэшируем "@username" бота, чтобы не обращаться к context.bot.username на каждое сообщение
+    global BOT_USERNAME_AT
+    BOT_USERNAME_AT = "@" + application.bot.username
+
+    # Общая aiohttp-сессия для запросов к OpenAI (keep-alive вместо соединения на каждый запрос)
+    await openai_utils.setup_aiosession()
+
+    # Индексы для горячих запросов к базе (создание идемпотентно)
+    await db.ensure_indexes()
+
+    # Запускаем фоновый сброс буфера last_interaction
+    global _last_interaction_flush_task
+    _last_interaction_flush_task = spawn(_last_interaction_flush_loop())
+
+    # Запускаем фоновый сброс очереди статистики токенов
+    global _token_flush_task
+    _token_flush_task = spawn(_token_flush_loop())
+
     await application.bot.set_my_commands([
         BotCommand("/new", "Начать новый диалог"),
         BotCommand("/mode", "Выбрать режим общения"),
@@ -1166,6 +1654,30 @@ async def post_init(application: Application):
     ])
 
 
+async def post_shutdown(application: Application):
+    """
+    Освобождает ресурсы при остановке бота.
+
+    Аргументы:
+    - application: объект Application, представляющий приложение бота.
+    """
+    # Останавливаем фоновый сброс и дописываем остаток буфера last_interaction
+    if _last_interaction_flush_task is not None:
+        _last_interaction_flush_task.cancel()
+    await _flush_last_interactions()
+
+    # Останавливаем фоновый сброс и дописываем остаток очереди статистики токенов
+    if _token_flush_task is not None:
+        _token_flush_task.cancel()
+    await _flush_token_updates()
+
+    # Отменяем оставшиеся фоновые задачи, чтобы они не зависли при остановке
+    for task in list(_background_tasks):
+        task.cancel()
+
+    await openai_utils.close_aiosession()
+
+
 def run_bot() -> None:
     """
         Запускает бота.
@@ -1174,36 +1686,43 @@ def run_bot() -> None:
         - Создает объект приложения бота и добавляет обработчики команд и сообщений.
         - Настраивает фильтры и запускает бота в режиме polling.
         """
+    # Глобальный rate limiter: держим исходящие вызовы в пределах лимитов Telegram
+    # (30 сообщений/с всего, 20 сообщений/мин на группу), чтобы не ловить 429 и повторные запросы
     application = (
         ApplicationBuilder()
         .token(config.telegram_token)
-        .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
+        # До 256 апдейтов обрабатываются одновременно (True дает дефолтные 256,
+        # но явное число не зависит от версии PTB)
+        .concurrent_updates(256)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3
+        ))
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
-    # Добавляем обработчики команд и сообщений
-    user_filter = filters.ALL
-    if len(config.allowed_telegram_usernames) > 0:
-        usernames = [x for x in config.allowed_telegram_usernames if isinstance(x, str)]
-        any_ids = [x for x in config.allowed_telegram_usernames if isinstance(x, int)]
-        user_ids = [x for x in any_ids if x > 0]
-        group_ids = [x for x in any_ids if x < 0]
-        user_filter = filters.User(username=usernames) | filters.User(user_id=user_ids) | filters.Chat(
-            chat_id=group_ids)
+    # Добавляем обработчики команд и сообщений (фильтр доступа собран при загрузке модуля).
+    # Составные фильтры собираем по одному разу и переиспользуем одни и те же объекты:
+    # PTB вычисляет каждый экземпляр фильтра для апдейта однократно
+    user_filter = USER_FILTER
+    not_command_user_filter = ~filters.COMMAND & user_filter
 
     application.add_handler(CommandHandler("start", start_handle, filters=user_filter))
     application.add_handler(CommandHandler("help", help_handle, filters=user_filter))
     application.add_handler(CommandHandler("help_group_chat", help_group_chat_handle, filters=user_filter))
 
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, message_handle))
-    application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND & user_filter, message_handle))
-    application.add_handler(MessageHandler(filters.VIDEO & ~filters.COMMAND & user_filter, unsupport_message_handle))
+    application.add_handler(MessageHandler(filters.TEXT & not_command_user_filter, message_handle))
+    application.add_handler(MessageHandler(filters.PHOTO & not_command_user_filter, message_handle))
+    application.add_handler(MessageHandler(filters.VIDEO & not_command_user_filter, unsupport_message_handle))
     application.add_handler(
-        MessageHandler(filters.Document.ALL & ~filters.COMMAND & user_filter, unsupport_message_handle))
+        MessageHandler(filters.Document.ALL & not_command_user_filter, unsupport_message_handle))
     application.add_handler(CommandHandler("retry", retry_handle, filters=user_filter))
     application.add_handler(CommandHandler("new", new_dialog_handle, filters=user_filter))
     application.add_handler(CommandHandler("cancel", cancel_handle, filters=user_filter))
@@ -1222,7 +1741,9 @@ def run_bot() -> None:
     application.add_error_handler(error_handle)
 
     # start the bot
-    application.run_polling()
+    # Длинный опрос: без пауз между запросами, сервер держит соединение до 30 с -
+    # меньше HTTPS round-trip'ов к api.telegram.org и больше апдейтов за запрос
+    application.run_polling(poll_interval=0.0, timeout=30)
 
 
 if __name__ == "__main__":
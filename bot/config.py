@@ -21,6 +21,10 @@ enable_message_streaming = config_yaml.get("enable_message_streaming", True)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "512x512")
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
+# TTL кеша результатов генерации изображений в секундах (0 - кеш выключен);
+# URL от OpenAI живут около часа, поэтому TTL держим с запасом ниже этого
+# срока - попадание в кеш на исходе часа отдало бы уже протухшие ссылки
+image_cache_ttl = config_yaml.get("image_cache_ttl", 1800)
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 
 # режимы чата
@@ -1,22 +1,71 @@
 from typing import Optional, Any
-import pymongo
+import asyncio
+import time
+import motor.motor_asyncio
 import uuid
-from datetime import datetime
+from collections import deque
+from bson import ObjectId
+from pymongo import UpdateOne, WriteConcern
+from datetime import datetime, timezone
 from bot import config
 
+# Предзагруженная временная зона для меток времени (без обращения к системной tz-базе)
+_UTC = timezone.utc
+
+# Горячие атрибуты пользователя, которые можно кешировать в памяти процесса
+_CACHED_USER_ATTRS = frozenset({"current_model", "current_chat_mode", "current_dialog_id", "last_interaction"})
+
+# Время жизни записи в кеше атрибутов, секунды
+_ATTR_CACHE_TTL = 300.0
+
+# Не писать last_interaction в Mongo чаще, чем раз в столько секунд
+_LAST_INTERACTION_FLUSH_INTERVAL = 60
+
+# Ограничение размера кеша атрибутов (защита от неограниченного роста памяти)
+_ATTR_CACHE_MAX_SIZE = 50_000
+
+# Максимальное число сообщений, хранимых в одном диалоге: старые сообщения
+# отсекаются на стороне сервера, чтобы документ не рос до лимита BSON
+_MAX_DIALOG_MESSAGES = 500
+
+# Общий клиент MongoDB (ленивый синглтон): у каждого клиента свой пул соединений
+# и мониторинг сервера, поэтому все экземпляры Database делят один
+_client = None
+
+
+def _get_client():
+    """
+    Возвращает общий AsyncIOMotorClient, создавая его при первом обращении.
+    """
+    global _client
+    if _client is None:
+        # Сжатие трафика: messages-массивы диалогов - это килобайты текста,
+        # сжимающегося в разы. Сервер выбирает первый поддерживаемый им
+        # кодек из списка; zstd/snappy требуют соответствующих пакетов на
+        # клиенте (pymongo их молча пропускает), zlib доступен всегда.
+        _client = motor.motor_asyncio.AsyncIOMotorClient(
+            config.mongodb_uri,
+            maxPoolSize=50,
+            appname="chatgpt_tg_bot",
+            compressors="zstd,snappy,zlib",
+            zlibCompressionLevel=6,
+        )
+    return _client
+
 class Database:
     """
     Класс для работы с базой данных MongoDB.
 
     Инициализирует подключение к базе данных и определяет коллекции для работы с пользователями и диалогами.
+    Все методы асинхронные (драйвер motor), чтобы запросы к базе не блокировали event loop бота.
     """
 
     def __init__(self):
         """
         Инициализирует подключение к базе данных и коллекциям.
         """
-        # Подключаемся к MongoDB по URI, указанному в конфигурации
-        self.client = pymongo.MongoClient(config.mongodb_uri)
+        # Общий клиент MongoDB (ленивый синглтон с пулом соединений)
+        self.client = _get_client()
         # Выбираем базу данных "chatgpt_telegram_bot"
         self.db = self.client["chatgpt_telegram_bot"]
 
@@ -24,7 +73,71 @@ class Database:
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        # Хранилище GridFS для изображений (чтобы не хранить их base64 внутри диалогов)
+        self.image_bucket = motor.motor_asyncio.AsyncIOMotorGridFSBucket(self.db, bucket_name="image")
+
+        # Процесс-локальный кеш горячих атрибутов пользователя: (user_id, key) -> (срок годности, значение).
+        # Бот работает в одном event loop, поэтому блокировка не нужна; худший случай
+        # гонки - лишний запрос к Mongo.
+        self._attr_cache = {}
+
+        # Очередь отложенных операций статистики токенов: update_n_used_tokens
+        # кладет сюда UpdateOne, фоновая задача бота сбрасывает очередь одним
+        # bulk_write через flush_token_updates.
+        self._pending_token_ops = deque()
+
+        # Представление коллекции пользователей с write concern w=0 для
+        # статистических записей (токены, last_interaction): клиент не ждет
+        # подтверждения сервера, а потеря одной такой записи при сбое безвредна.
+        # Создание пользователей и диалогов остается на w=1 по умолчанию.
+        self._stats_user_collection = self.user_collection.with_options(
+            write_concern=WriteConcern(w=0)
+        )
+
+    def _cache_get(self, user_id: int, key: str):
+        """
+        Возвращает (True, значение) при попадании в кеш атрибутов, иначе (False, None).
+        """
+        entry = self._attr_cache.get((user_id, key))
+        if entry is None:
+            return False, None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._attr_cache[(user_id, key)]
+            return False, None
+
+        return True, value
+
+    def _cache_put(self, user_id: int, key: str, value: Any):
+        """
+        Кладет значение горячего атрибута в кеш (остальные атрибуты не кешируются).
+        """
+        if key not in _CACHED_USER_ATTRS:
+            return
+
+        if len(self._attr_cache) >= _ATTR_CACHE_MAX_SIZE:
+            # Вытесняем самую старую запись (dict сохраняет порядок вставки)
+            self._attr_cache.pop(next(iter(self._attr_cache)), None)
+
+        self._attr_cache[(user_id, key)] = (time.monotonic() + _ATTR_CACHE_TTL, value)
+
+    async def ensure_indexes(self):
+        """
+        Создает индексы для горячих запросов (операция идемпотентна).
+
+        Описание:
+        - Вызывается один раз при старте бота (post_init): с motor в __init__
+          await невозможен.
+        - Составной индекс (user_id, _id) обслуживает поиск диалога по
+          {_id, user_id} без стадии пост-фильтрации по user_id.
+        - Дополнительные индексы по коллекции пользователей не нужны: запросы
+          с равенством по _id сервер выполняет по особому пути (IDHACK) через
+          сам индекс _id и вторичные индексы для них не использует.
+        """
+        await self.dialog_collection.create_index([("user_id", 1), ("_id", 1)])
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         """
         Проверяет, существует ли пользователь с данным идентификатором в базе данных.
 
@@ -38,7 +151,9 @@ class Database:
         Исключение:
         - ValueError: если raise_exception=True и пользователь не существует.
         """
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        # Точечный поиск по первичному ключу: find_one с проекцией _id обслуживается
+        # прямо из индекса, в отличие от count_documents, идущего через команду count
+        if await self.user_collection.find_one({"_id": user_id}, projection={"_id": 1}) is not None:
             return True
         else:
             if raise_exception:
@@ -46,7 +161,7 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -65,18 +180,18 @@ class Database:
         - last_name: фамилия пользователя (опционально).
 
         Описание:
-        - Если пользователь с таким user_id не существует, он добавляется в коллекцию "user".
+        - Идемпотентная вставка через upsert с $setOnInsert: один round-trip,
+          и два параллельных /start не приводят к ошибке дублирования ключа.
         """
         user_dict = {
-            "_id": user_id,  # Идентификатор пользователя как первичный ключ
             "chat_id": chat_id,  # Идентификатор чата
 
             "username": username,  # Имя пользователя
             "first_name": first_name,  # Имя
             "last_name": last_name,  # Фамилия
 
-            "last_interaction": datetime.now(),  # Время последнего взаимодействия
-            "first_seen": datetime.now(),  # Время первого взаимодействия
+            "last_interaction": int(time.time()),  # Время последнего взаимодействия (unix-время)
+            "first_seen": datetime.now(_UTC),  # Время первого взаимодействия
 
             "current_dialog_id": None,  # Идентификатор текущего диалога
             "current_chat_mode": "assistant",  # Текущий режим общения
@@ -88,11 +203,14 @@ class Database:
             "n_transcribed_seconds": 0.0  # Время распознанных голосовых сообщений
         }
 
-        # Добавляем пользователя в базу, если он не существует
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+        # Добавляем пользователя, если он не существует; существующий документ не трогаем
+        await self.user_collection.update_one(
+            {"_id": user_id},
+            {"$setOnInsert": user_dict},
+            upsert=True
+        )
 
-    def start_new_dialog(self, user_id: int):
+    async def start_new_dialog(self, user_id: int):
         """
         Начинает новый диалог для указанного пользователя.
 
@@ -104,33 +222,106 @@ class Database:
 
         Описание:
         - Создает новый диалог и обновляет текущий диалог пользователя в базе данных.
+        - Режим и модель читаются одним find_one (он же проверяет существование
+          пользователя), а вставка диалога и обновление пользователя идут
+          параллельно: два round-trip по времени вместо пяти последовательных.
         """
-        # Проверяем, существует ли пользователь
-        self.check_if_user_exists(user_id, raise_exception=True)
+        user_dict = await self.user_collection.find_one(
+            {"_id": user_id},
+            projection={"_id": 0, "current_chat_mode": 1, "current_model": 1}
+        )
+        if user_dict is None:
+            raise ValueError(f"Пользователь {user_id} не существует")
 
         # Генерируем уникальный идентификатор диалога
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,  # Идентификатор диалога
             "user_id": user_id,  # Идентификатор пользователя
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),  # Текущий режим общения
-            "start_time": datetime.now(),  # Время начала диалога
-            "model": self.get_user_attribute(user_id, "current_model"),  # Текущая модель для общения
+            "chat_mode": user_dict.get("current_chat_mode"),  # Текущий режим общения
+            "start_time": datetime.now(_UTC),  # Время начала диалога
+            "model": user_dict.get("current_model"),  # Текущая модель для общения
             "messages": []  # Список сообщений в диалоге
         }
 
-        # Добавляем новый диалог в коллекцию
-        self.dialog_collection.insert_one(dialog_dict)
-
-        # Обновляем текущий диалог пользователя
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
+        # Добавляем диалог и переключаем на него пользователя параллельно
+        self._cache_put(user_id, "current_dialog_id", dialog_id)
+        await asyncio.gather(
+            self.dialog_collection.insert_one(dialog_dict),
+            self.user_collection.update_one(
+                {"_id": user_id},
+                {"$set": {"current_dialog_id": dialog_id}}
+            ),
         )
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
+    async def get_user_doc(self, user_id: int) -> Optional[dict]:
+        """
+        Возвращает документ пользователя целиком одним запросом.
+
+        Аргументы:
+        - user_id: идентификатор пользователя.
+
+        Возвращает:
+        - Словарь с данными пользователя или None, если пользователь не найден.
+
+        Описание:
+        - Используется горячими обработчиками, чтобы прочитать все атрибуты
+          за один round-trip вместо нескольких get_user_attribute.
+        - Попутно прогревает кеш горячих атрибутов.
+        """
+        user_dict = await self.user_collection.find_one({"_id": user_id})
+
+        if user_dict is not None:
+            for key in _CACHED_USER_ATTRS:
+                if key in user_dict:
+                    self._cache_put(user_id, key, user_dict[key])
+
+        return user_dict
+
+    async def bulk_set_user_attributes(self, user_id: int, values: dict):
+        """
+        Устанавливает несколько атрибутов пользователя одним запросом.
+
+        Аргументы:
+        - user_id: идентификатор пользователя.
+        - values: словарь {ключ: значение} для обновления.
+
+        Описание:
+        - Объединяет несколько set_user_attribute в один update_one с $set.
+        """
+        if not values:
+            return
+
+        for key, value in values.items():
+            self._cache_put(user_id, key, value)
+
+        await self.user_collection.update_one({"_id": user_id}, {"$set": values})
+
+    async def flush_last_interactions(self, values: dict):
+        """
+        Записывает накопленные значения last_interaction одним bulk_write.
+
+        Аргументы:
+        - values: словарь {user_id: unix-время последнего взаимодействия}.
+
+        Описание:
+        - Используется фоновой задачей бота вместо отдельного update_one на каждый
+          апдейт Telegram; ordered=False позволяет серверу применять операции параллельно.
+        """
+        if not values:
+            return
+
+        for user_id, ts in values.items():
+            self._cache_put(user_id, "last_interaction", ts)
+
+        await self._stats_user_collection.bulk_write(
+            [UpdateOne({"_id": user_id}, {"$set": {"last_interaction": ts}}) for user_id, ts in values.items()],
+            ordered=False
+        )
+
+    async def get_user_attribute(self, user_id: int, key: str):
         """
         Получает значение атрибута пользователя по ключу.
 
@@ -142,21 +333,54 @@ class Database:
         - Значение атрибута, если он существует, иначе None.
 
         Описание:
-        - Проверяет наличие пользователя в базе данных и возвращает запрашиваемый атрибут.
+        - Горячие атрибуты (_CACHED_USER_ATTRS) сначала ищутся в процесс-локальном кеше,
+          чтобы не ходить в Mongo на каждый апдейт Telegram.
         """
-        # Проверяем, существует ли пользователь
-        self.check_if_user_exists(user_id, raise_exception=True)
+        # Горячие атрибуты читаем из кеша, если запись еще не протухла
+        hit, value = self._cache_get(user_id, key)
+        if hit:
+            return value
 
-        # Ищем пользователя в базе данных
-        user_dict = self.user_collection.find_one({"_id": user_id})
+        # Один round-trip вместо двух: отсутствие документа означает,
+        # что пользователя нет, а проекция не тянет лишние поля по сети
+        user_dict = await self.user_collection.find_one({"_id": user_id}, projection={"_id": 0, key: 1})
+        if user_dict is None:
+            raise ValueError(f"Пользователь {user_id} не существует")
 
         # Возвращаем значение атрибута, если он существует
-        if key not in user_dict:
-            return None
+        value = user_dict.get(key)
+        self._cache_put(user_id, key, value)
+        return value
 
-        return user_dict[key]
+    async def get_user_attributes(self, user_id: int, keys: list):
+        """
+        Получает несколько атрибутов пользователя одним запросом.
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
+        Аргументы:
+        - user_id: идентификатор пользователя.
+        - keys: список ключей атрибутов.
+
+        Возвращает:
+        - Словарь {ключ: значение}; отсутствующие в документе ключи получают None.
+
+        Описание:
+        - Использует проекцию find_one, чтобы прочитать все ключи за один round-trip
+          вместо отдельного get_user_attribute на каждый.
+        """
+        user_dict = await self.user_collection.find_one(
+            {"_id": user_id},
+            projection={key: 1 for key in keys}
+        )
+        if user_dict is None:
+            raise ValueError(f"Пользователь {user_id} не существует")
+
+        for key in keys:
+            if key in _CACHED_USER_ATTRS and key in user_dict:
+                self._cache_put(user_id, key, user_dict[key])
+
+        return {key: user_dict.get(key) for key in keys}
+
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
         """
         Устанавливает значение атрибута пользователя.
 
@@ -166,15 +390,28 @@ class Database:
         - value: новое значение атрибута.
 
         Описание:
-        - Проверяет наличие пользователя в базе данных и обновляет значение атрибута.
+        - Пишет сквозь кеш: сначала обновляет кеш горячих атрибутов, затем Mongo.
+        - Для last_interaction запись в Mongo коалесцируется: если кешированное значение
+          свежее _LAST_INTERACTION_FLUSH_INTERVAL секунд, обновляется только кеш.
         """
-        # Проверяем, существует ли пользователь
-        self.check_if_user_exists(user_id, raise_exception=True)
+        if key == "last_interaction":
+            hit, cached = self._cache_get(user_id, key)
+            if hit and isinstance(cached, int) and isinstance(value, int) \
+                    and value - cached < _LAST_INTERACTION_FLUSH_INTERVAL:
+                self._cache_put(user_id, key, value)
+                return
+
+        # Обновляем значение атрибута; matched_count заменяет предварительную
+        # проверку существования пользователя (один round-trip вместо двух)
+        result = await self.user_collection.update_one(
+            {"_id": user_id}, {"$set": {key: value}}, upsert=False
+        )
+        if result.matched_count == 0:
+            raise ValueError(f"Пользователь {user_id} не существует")
 
-        # Обновляем значение атрибута в базе данных
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        self._cache_put(user_id, key, value)
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
+    async def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
         """
         Обновляет статистику использования токенов для пользователя.
 
@@ -185,26 +422,61 @@ class Database:
         - n_output_tokens: количество выходных токенов.
 
         Описание:
-        - Добавляет или обновляет информацию о количестве использованных токенов для указанной модели.
+        - Операция не выполняется сразу, а кладется в очередь _pending_token_ops;
+          фоновая задача бота периодически сбрасывает очередь одним bulk_write
+          (flush_token_updates). $inc атомарен на стороне сервера, поэтому
+          отложенное применение не теряет точности, а статистика не критична
+          к задержке записи в доли секунды.
         """
-        # Получаем текущую статистику использования токенов
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        self._pending_token_ops.append(UpdateOne(
+            {"_id": user_id},
+            {"$inc": {
+                f"n_used_tokens.{model}.n_input_tokens": n_input_tokens,
+                f"n_used_tokens.{model}.n_output_tokens": n_output_tokens,
+            }},
+        ))
 
-        # Если статистика для данной модели уже существует, обновляем её
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens  # Увеличиваем количество входных токенов
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens  # Увеличиваем количество выходных токенов
-        else:
-            # Если статистики для данной модели нет, создаем новую запись
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,  # Устанавливаем количество входных токенов
-                "n_output_tokens": n_output_tokens  # Устанавливаем количество выходных токенов
-            }
+    async def flush_token_updates(self):
+        """
+        Сбрасывает очередь отложенных обновлений статистики токенов одним bulk_write.
+
+        Описание:
+        - Вызывается фоновой задачей бота раз в доли секунды и при остановке;
+          ordered=False позволяет серверу применять операции параллельно.
+        """
+        if not self._pending_token_ops:
+            return
+
+        ops = []
+        while self._pending_token_ops:
+            ops.append(self._pending_token_ops.popleft())
 
-        # Сохраняем обновленную статистику использования токенов в базе данных
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        await self._stats_user_collection.bulk_write(ops, ordered=False)
+
+    async def finalize_turn(self, user_id: int, dialog_message: dict, model: str,
+                            n_input_tokens: int, n_output_tokens: int, dialog_id: Optional[str] = None):
+        """
+        Завершает ход диалога: сохраняет сообщение и статистику токенов.
+
+        Аргументы:
+        - user_id: идентификатор пользователя.
+        - dialog_message: сообщение, которое нужно добавить в диалог.
+        - model: название модели.
+        - n_input_tokens: количество входных токенов.
+        - n_output_tokens: количество выходных токенов.
+        - dialog_id: идентификатор диалога (опционально).
+
+        Описание:
+        - Сообщение и токены пишутся в разные коллекции, поэтому объединить их в один
+          update_one нельзя; вместо этого обе записи выполняются параллельно, и ход
+          занимает время одного round-trip вместо двух последовательных.
+        """
+        await asyncio.gather(
+            self.append_dialog_message(user_id, dialog_message, dialog_id=dialog_id),
+            self.update_n_used_tokens(user_id, model, n_input_tokens, n_output_tokens),
+        )
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
         """
         Возвращает список сообщений из указанного диалога пользователя.
 
@@ -217,21 +489,82 @@ class Database:
 
         Описание:
         - Если идентификатор диалога не указан, используется текущий диалог пользователя.
+        - Проекция тянет по сети только массив сообщений, без метаданных диалога;
+          отдельная проверка существования пользователя не нужна - запрос и так
+          фильтрует по user_id (а get_user_attribute проверяет пользователя сам).
         """
-        # Проверяем, существует ли пользователь
-        self.check_if_user_exists(user_id, raise_exception=True)
-
         # Если идентификатор диалога не указан, получаем текущий диалог
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        # Ищем диалог в базе данных
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        # Ищем диалог в базе данных (только поле messages)
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            projection={"messages": 1, "_id": 0}
+        )
 
         # Возвращаем список сообщений из диалога
         return dialog_dict["messages"]
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+    async def put_image(self, data, filename: str = "image.jpg"):
+        """
+        Сохраняет изображение в GridFS и возвращает его идентификатор.
+
+        Аргументы:
+        - data: байты изображения (bytes или memoryview).
+        - filename: имя файла для GridFS (опционально).
+
+        Возвращает:
+        - Идентификатор сохраненного файла.
+
+        Описание:
+        - Изображения хранятся отдельно от документов диалогов, поэтому чтение истории
+          диалога не тянет по сети мегабайты base64 за каждое старое изображение.
+        """
+        return await self.image_bucket.upload_from_stream(filename, bytes(data))
+
+    async def get_image(self, image_id) -> bytes:
+        """
+        Читает изображение из GridFS по идентификатору.
+
+        Аргументы:
+        - image_id: идентификатор файла, возвращенный put_image
+          (ObjectId или его строковое представление из истории диалога).
+
+        Возвращает:
+        - Байты изображения.
+        """
+        if isinstance(image_id, str):
+            image_id = ObjectId(image_id)
+        stream = await self.image_bucket.open_download_stream(image_id)
+        return await stream.read()
+
+    async def append_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        """
+        Добавляет одно сообщение в конец указанного диалога пользователя.
+
+        Аргументы:
+        - user_id: идентификатор пользователя.
+        - dialog_message: сообщение, которое нужно добавить.
+        - dialog_id: идентификатор диалога (опционально). Если не указан, используется текущий диалог.
+
+        Описание:
+        - Использует $push на стороне сервера, поэтому по сети передается только новое
+          сообщение, а не вся история диалога (в отличие от set_dialog_messages).
+        - $slice ограничивает историю последними _MAX_DIALOG_MESSAGES сообщениями
+          в той же операции, чтобы документ диалога не рос неограниченно.
+        """
+        # Если идентификатор диалога не указан, используем текущий диалог
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        # Добавляем сообщение в конец массива на стороне сервера
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": {"$each": [dialog_message], "$slice": -_MAX_DIALOG_MESSAGES}}}
+        )
+
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
         """
         Обновляет список сообщений в указанном диалоге пользователя.
 
@@ -244,14 +577,14 @@ class Database:
         - Обновляет список сообщений в базе данных для указанного диалога.
         """
         # Проверяем, существует ли пользователь
-        self.check_if_user_exists(user_id, raise_exception=True)
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         # Если идентификатор диалога не указан, используем текущий диалог
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
         # Обновляем список сообщений в диалоге
-        self.dialog_collection.update_one(
+        await self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
             {"$set": {"messages": dialog_messages}}
         )
@@ -1,8 +1,11 @@
 import base64
+import functools
+import time
 from io import BytesIO
 from bot import config
 import logging
 
+import aiohttp
 import tiktoken
 import openai
 
@@ -13,6 +16,24 @@ if config.openai_api_base is not None:
 logger = logging.getLogger(__name__)
 
 # Опции для завершения запроса к OpenAI
+# Маршрутизация запросов по моделям: _CHAT_MODELS идут через ChatCompletion,
+# _VISION_MODELS дополнительно принимают изображения, text-davinci-003 - через
+# Completion. Наборы вынесены на уровень модуля, чтобы не пересоздавать
+# set-литералы на каждый вызов.
+_CHAT_MODELS = frozenset({"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview"})
+_VISION_MODELS = frozenset({"gpt-4-vision-preview", "gpt-4o"})
+_SUPPORTED_MODELS = frozenset({"text-davinci-003"}) | _CHAT_MODELS | _VISION_MODELS
+
+# Допустимые режимы чата; config.chat_modes загружается из YAML один раз при
+# импорте, поэтому набор можно заморозить на уровне модуля
+_CHAT_MODES = frozenset(config.chat_modes)
+
+# Троттлинг потоковых yield'ов: не чаще одного раза в _STREAM_YIELD_INTERVAL
+# секунд либо при накоплении _STREAM_YIELD_CHARS новых символов; финальный
+# yield отправляется всегда
+_STREAM_YIELD_INTERVAL = 0.7
+_STREAM_YIELD_CHARS = 100
+
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,  # Температура для генерации текста
     "max_tokens": 1000,  # Максимальное количество токенов в ответе
@@ -23,6 +44,41 @@ OPENAI_COMPLETION_OPTIONS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """
+    Возвращает кодировку tiktoken для модели, кешируя ее на процесс.
+
+    Описание:
+    - encoding_for_model загружает BPE-словарь; без кеша потоковые методы
+      переплачивали бы эту стоимость на каждом дельта-чанке.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+async def setup_aiosession():
+    """
+    Создает общую aiohttp-сессию для всех асинхронных запросов к OpenAI.
+
+    Описание:
+    - Без общей сессии библиотека openai открывает новое соединение (включая TLS-handshake)
+      на каждый запрос; keep-alive пул убирает эту задержку с пути первого токена.
+    """
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60.0)
+    )
+    openai.aiosession.set(session)
+
+
+async def close_aiosession():
+    """
+    Закрывает общую aiohttp-сессию при остановке бота.
+    """
+    session = openai.aiosession.get()
+    if session is not None:
+        await session.close()
+
+
 class ChatGPT:
     def __init__(self, model="gpt-3.5-turbo"):
         """
@@ -33,8 +89,7 @@ class ChatGPT:
                       "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o",
                       "gpt-4-1106-preview", "gpt-4-vision-preview".
         """
-        assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o",
-                         "gpt-4-1106-preview", "gpt-4-vision-preview"}, f"Unknown model: {model}"
+        assert model in _SUPPORTED_MODELS, f"Unknown model: {model}"
         self.model = model
 
     async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
@@ -46,15 +101,14 @@ class ChatGPT:
         :param chat_mode: Режим чата (например, "assistant").
         :return: Кортеж, содержащий ответ, токены ввода и вывода, и количество удаленных сообщений диалога.
         """
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in _CHAT_MODES:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview",
-                                  "gpt-4-vision-preview"}:
+                if self.model in _CHAT_MODELS or self.model in _VISION_MODELS:
                     messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
 
                     r = await openai.ChatCompletion.acreate(
@@ -97,14 +151,14 @@ class ChatGPT:
         :param chat_mode: Режим чата (например, "assistant").
         :return: Генератор, который выдает статус выполнения, частичный ответ, токены ввода и вывода, и количество удаленных сообщений диалога.
         """
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in _CHAT_MODES:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
-                if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4o", "gpt-4-1106-preview"}:
+                if self.model in _CHAT_MODELS:
                     messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
 
                     r_gen = await openai.ChatCompletion.acreate(
@@ -114,18 +168,42 @@ class ChatGPT:
                         **OPENAI_COMPLETION_OPTIONS
                     )
 
+                    # Токены промпта считаем один раз, дальше инкрементально
+                    # кодируем только новые дельты: O(N) вместо O(N^2)
+                    encoding = _get_encoding(self.model)
+                    n_input_tokens = self._count_input_tokens_from_messages(messages, model=self.model)
+                    n_output_tokens = 1
+
                     answer = ""
+                    n_first_dialog_messages_removed = 0
+                    # Дельты копятся в pending и кодируются одним вызовом encode
+                    # на сброс, а не по одной: меньше FFI-вызовов в tiktoken
+                    pending = []
+                    pending_len = 0
+                    last_yield_ts = time.monotonic()
                     async for r_item in r_gen:
                         delta = r_item.choices[0].delta
 
                         if "content" in delta:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer,
-                                                                                               model=self.model)
-                            n_first_dialog_messages_removed = 0
-
-                            yield "not_finished", answer, (
-                            n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                            pending.append(delta.content)
+                            pending_len += len(delta.content)
+
+                            now = time.monotonic()
+                            if now - last_yield_ts > _STREAM_YIELD_INTERVAL or pending_len > _STREAM_YIELD_CHARS:
+                                chunk = "".join(pending)
+                                pending.clear()
+                                pending_len = 0
+                                answer += chunk
+                                n_output_tokens += len(encoding.encode(chunk))
+                                last_yield_ts = now
+                                yield "not_finished", answer, (
+                                n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                    # Дописываем недосброшенный хвост потока
+                    if pending:
+                        chunk = "".join(pending)
+                        answer += chunk
+                        n_output_tokens += len(encoding.encode(chunk))
 
 
                 elif self.model == "text-davinci-003":
@@ -137,13 +215,35 @@ class ChatGPT:
                         **OPENAI_COMPLETION_OPTIONS
                     )
 
+                    # Токены промпта считаем один раз, дельты кодируем инкрементально
+                    encoding = _get_encoding(self.model)
+                    n_input_tokens = len(encoding.encode(prompt)) + 1
+                    n_output_tokens = 0
+
                     answer = ""
+                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                    # Дельты копятся в pending и кодируются одним вызовом encode на сброс
+                    pending = []
+                    pending_len = 0
+                    last_yield_ts = time.monotonic()
                     async for r_item in r_gen:
-                        answer += r_item.choices[0].text
-                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer,
-                                                                                         model=self.model)
-                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                        yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                        pending.append(r_item.choices[0].text)
+                        pending_len += len(r_item.choices[0].text)
+                        now = time.monotonic()
+                        if now - last_yield_ts > _STREAM_YIELD_INTERVAL or pending_len > _STREAM_YIELD_CHARS:
+                            chunk = "".join(pending)
+                            pending.clear()
+                            pending_len = 0
+                            answer += chunk
+                            n_output_tokens += len(encoding.encode(chunk))
+                            last_yield_ts = now
+                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                    # Дописываем недосброшенный хвост потока
+                    if pending:
+                        chunk = "".join(pending)
+                        answer += chunk
+                        n_output_tokens += len(encoding.encode(chunk))
 
                 answer = self._postprocess_answer(answer)
 
@@ -177,7 +277,7 @@ class ChatGPT:
         answer = None
         while answer is None:
             try:
-                if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
+                if self.model in _VISION_MODELS:
                     messages = self._generate_prompt_messages(
                         message, dialog_messages, chat_mode, image_buffer
                     )
@@ -234,7 +334,7 @@ class ChatGPT:
         answer = None
         while answer is None:
             try:
-                if self.model == "gpt-4-vision-preview" or self.model == "gpt-4o":
+                if self.model in _VISION_MODELS:
                     messages = self._generate_prompt_messages(
                         message, dialog_messages, chat_mode, image_buffer
                     )
@@ -246,24 +346,43 @@ class ChatGPT:
                         **OPENAI_COMPLETION_OPTIONS,
                     )
 
+                    # Токены промпта считаем один раз, дельты кодируем инкрементально
+                    encoding = _get_encoding(self.model)
+                    n_input_tokens = self._count_input_tokens_from_messages(messages, model=self.model)
+                    n_output_tokens = 1
+
                     answer = ""
+                    n_first_dialog_messages_removed = (
+                            n_dialog_messages_before - len(dialog_messages)
+                    )
+                    # Дельты копятся в pending и кодируются одним вызовом encode на сброс
+                    pending = []
+                    pending_len = 0
+                    last_yield_ts = time.monotonic()
                     async for r_item in r_gen:
                         delta = r_item.choices[0].delta
                         if "content" in delta:
-                            answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
-                            )
-                            n_first_dialog_messages_removed = (
-                                    n_dialog_messages_before - len(dialog_messages)
-                            )
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
+                            pending.append(delta.content)
+                            pending_len += len(delta.content)
+
+                            now = time.monotonic()
+                            if now - last_yield_ts > _STREAM_YIELD_INTERVAL or pending_len > _STREAM_YIELD_CHARS:
+                                chunk = "".join(pending)
+                                pending.clear()
+                                pending_len = 0
+                                answer += chunk
+                                n_output_tokens += len(encoding.encode(chunk))
+                                last_yield_ts = now
+                                yield "not_finished", answer, (
+                                    n_input_tokens,
+                                    n_output_tokens,
+                                ), n_first_dialog_messages_removed
+
+                    # Дописываем недосброшенный хвост потока
+                    if pending:
+                        chunk = "".join(pending)
+                        answer += chunk
+                        n_output_tokens += len(encoding.encode(chunk))
 
                 answer = self._postprocess_answer(answer)
 
@@ -303,14 +422,19 @@ class ChatGPT:
 
         return prompt
 
-    def _encode_image(self, image_buffer: BytesIO) -> bytes:
+    def _encode_image(self, image_buffer: BytesIO) -> str:
         """
         Кодирует изображение из буфера в формат base64.
 
         :param image_buffer: Буфер с изображением в формате BytesIO.
         :return: Изображение в формате base64.
+
+        Описание:
+        - getbuffer() отдает memoryview без копирования содержимого буфера
+          (read() создавал бы промежуточную копию байтов); base64 всегда
+          укладывается в ASCII.
         """
-        return base64.b64encode(image_buffer.read()).decode("utf-8")
+        return base64.b64encode(image_buffer.getbuffer()).decode("ascii")
 
     def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
         """
@@ -327,7 +451,12 @@ class ChatGPT:
         messages = [{"role": "system", "content": prompt}]
 
         for dialog_message in dialog_messages:
-            messages.append({"role": "user", "content": dialog_message["user"]})
+            user_content = dialog_message["user"]
+            if isinstance(user_content, list):
+                # В историю из vision-диалогов попадают части {"type": "image",
+                # "image_id": ...} - API такой тип не принимает, оставляем только текст
+                user_content = [part for part in user_content if part.get("type") == "text"]
+            messages.append({"role": "user", "content": user_content})
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
 
         if image_buffer is not None:
@@ -365,16 +494,19 @@ class ChatGPT:
         answer = answer.strip()
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
+    def _count_input_tokens_from_messages(self, messages, model="gpt-3.5-turbo"):
         """
-        Подсчитывает количество токенов в сообщениях и ответе.
+        Подсчитывает количество токенов запроса (без ответа).
 
         :param messages: Список сообщений для подсчета токенов.
-        :param answer: Ответ модели для подсчета токенов.
         :param model: Модель, которая используется для подсчета токенов.
-        :return: Кортеж из количества токенов ввода и вывода.
+        :return: Количество токенов ввода.
+
+        Описание:
+        - Вынесено отдельно, чтобы потоковые методы считали промпт один раз,
+          а не заново на каждом дельта-чанке.
         """
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = _get_encoding(model)
 
         if model == "gpt-3.5-turbo-16k":
             tokens_per_message = 4  # Каждый сообщение имеет формат <im_start>{role/name}\n{content}<im_end>\n
@@ -397,28 +529,38 @@ class ChatGPT:
         else:
             raise ValueError(f"Unknown model: {model}")
 
-        # Ввод
-        n_input_tokens = 0
+        # Ввод: собираем все текстовые куски и кодируем их одним encode_batch -
+        # tiktoken отпускает GIL и токенизирует список параллельно на стороне Rust,
+        # вместо отдельного FFI-вызова на каждое сообщение
+        n_input_tokens = tokens_per_message * len(messages)
+        texts = []
         for message in messages:
-            n_input_tokens += tokens_per_message
             if isinstance(message["content"], list):
                 for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
+                    if sub_message.get("type") == "text":
+                        texts.append(sub_message["text"])
             else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
+                if message.get("type") == "text":
+                    texts.append(message["text"])
+
+        if texts:
+            n_input_tokens += sum(len(tokens) for tokens in encoding.encode_batch(texts))
 
         n_input_tokens += 2
 
-        # Вывод
-        n_output_tokens = 1 + len(encoding.encode(answer))
+        return n_input_tokens
+
+    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
+        """
+        Подсчитывает количество токенов в сообщениях и ответе.
+
+        :param messages: Список сообщений для подсчета токенов.
+        :param answer: Ответ модели для подсчета токенов.
+        :param model: Модель, которая используется для подсчета токенов.
+        :return: Кортеж из количества токенов ввода и вывода.
+        """
+        n_input_tokens = self._count_input_tokens_from_messages(messages, model=model)
+        n_output_tokens = 1 + len(_get_encoding(model).encode(answer))
 
         return n_input_tokens, n_output_tokens
 
@@ -431,7 +573,7 @@ class ChatGPT:
         :param model: Модель, которая используется для подсчета токенов.
         :return: Кортеж из количества токенов ввода и вывода.
         """
-        encoding = tiktoken.encoding_for_model(model)
+        encoding = _get_encoding(model)
 
         n_input_tokens = len(encoding.encode(prompt)) + 1
         n_output_tokens = len(encoding.encode(answer))